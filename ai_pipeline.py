@@ -1,27 +1,120 @@
 import os
 import re
+import csv
 import json
+import time
 import base64
+import hashlib
+import uuid
+from contextlib import ExitStack, contextmanager
+from datetime import date, datetime
 import pdfplumber
 import io
 import pandas as pd
+import numpy as np
 import groq
+from collections import OrderedDict
 from PIL import Image
 from pathlib import Path
 from dotenv import load_dotenv
 import os
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+    pa_csv = None
+
 load_dotenv()
 
-# Initialize Groq client only
-groq_client = groq.Groq(api_key="GROQ_API_KEY")
+# Initialize Groq client only; GROQ_MAX_RETRIES overrides the SDK's retry count (2)
+groq_client = groq.Groq(api_key="GROQ_API_KEY", max_retries=int(os.getenv("GROQ_MAX_RETRIES", "2")))
+
+
+# ---------------- 📥 INPUT SOURCES ----------------
+# Pipeline inputs may be a path, raw bytes/bytearray/memoryview, a binary
+# file-like object, or a (name, bytes-or-file-like) tuple such as
+# (upload.filename, upload.file). In-memory inputs never touch the disk.
+
+def _source_path(source):
+    """Filesystem path of a source, or None for in-memory inputs"""
+    if isinstance(source, (str, os.PathLike)):
+        return os.fspath(source)
+    return None
+
+
+def _source_data(source):
+    """Unwrap a (name, data) tuple"""
+    return source[1] if isinstance(source, tuple) else source
+
+
+def source_name(source):
+    """File name used for type detection and reporting"""
+    path = _source_path(source)
+    if path is not None:
+        return os.path.basename(path)
+    if isinstance(source, tuple):
+        return os.path.basename(str(source[0]))
+    name = getattr(source, "name", None) or getattr(source, "filename", None)
+    return os.path.basename(name) if isinstance(name, str) else "upload"
+
+
+def source_exists(source):
+    path = _source_path(source)
+    return os.path.exists(path) if path is not None else _source_data(source) is not None
+
+
+def source_size(source):
+    """Size in bytes without reading the content"""
+    path = _source_path(source)
+    if path is not None:
+        return os.path.getsize(path)
+    data = _source_data(source)
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return memoryview(data).nbytes
+    position = data.tell()
+    size = data.seek(0, os.SEEK_END)
+    data.seek(position)
+    return size
+
+
+@contextmanager
+def open_source(source):
+    """Binary file-like object positioned at the start of the source"""
+    path = _source_path(source)
+    if path is not None:
+        with open(path, "rb") as f:
+            yield f
+        return
+    data = _source_data(source)
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        yield io.BytesIO(data)
+    else:
+        data.seek(0)
+        yield data  # Caller owns the object; don't close it
+
+
+def read_source(source):
+    """Full content as bytes (no copy for bytes inputs)"""
+    data = _source_data(source)
+    if isinstance(data, bytes):
+        return data
+    if isinstance(data, (bytearray, memoryview)):
+        return bytes(data)
+    with open_source(source) as f:
+        return f.read()
 
 
 # ---------------- 🧾 FILE TYPE DETECTION ----------------
 def get_file_type(file_path):
     """Detect file type based on extension and content"""
-    file_path = Path(file_path)
-    extension = file_path.suffix.lower()
+    extension = Path(source_name(file_path)).suffix.lower()
     
     if extension == '.pdf':
         return 'pdf'
@@ -32,7 +125,7 @@ def get_file_type(file_path):
     else:
         # Try to detect by content
         try:
-            with open(file_path, 'rb') as f:
+            with open_source(file_path) as f:
                 header = f.read(4)
                 if header.startswith(b'%PDF'):
                     return 'pdf'
@@ -41,6 +134,220 @@ def get_file_type(file_path):
         return 'unknown'
 
 
+# ---------------- 📊 CSV / TSV INGESTION ----------------
+CSV_STREAMING_THRESHOLD_BYTES = 5 * 1024 * 1024   # Larger files are read in chunks, never loaded whole
+CSV_FULL_MAX_ROWS = 500                           # Longer tables are summarized instead of sent to the model in full
+CSV_CHUNK_ROWS = 50_000
+CSV_SNIFF_BYTES = 64 * 1024
+CSV_HEAD_ROWS = 10
+CSV_MAX_TRACKED_VALUES = 20                       # Distinct values tracked per text column
+
+
+def sniff_csv_format(csv_path):
+    """Detect encoding and delimiter from the first bytes of a delimited file"""
+    with open_source(csv_path) as f:
+        raw = f.read(CSV_SNIFF_BYTES)
+
+    if raw.startswith((b"\xff\xfe", b"\xfe\xff")):
+        encoding = "utf-16"
+    else:
+        # Ignore a multi-byte character cut off at the sample boundary
+        probe = raw[:-4] if len(raw) == CSV_SNIFF_BYTES else raw
+        encoding = "latin-1"
+        for candidate in ("utf-8-sig", "cp1252"):
+            try:
+                probe.decode(candidate)
+                encoding = candidate
+                break
+            except UnicodeDecodeError:
+                continue
+
+    sample = raw.decode(encoding, errors="ignore")
+    # Only sniff complete lines
+    if len(raw) == CSV_SNIFF_BYTES and "\n" in sample:
+        sample = sample[:sample.rindex("\n")]
+
+    try:
+        delimiter = csv.Sniffer().sniff(sample, delimiters=",\t;|").delimiter
+    except csv.Error:
+        delimiter = "\t" if Path(source_name(csv_path)).suffix.lower() == ".tsv" else ","
+
+    header = next(csv.reader(io.StringIO(sample), delimiter=delimiter), [])
+    return encoding, delimiter, [h.strip() for h in header]
+
+
+def _use_pyarrow(encoding, columns):
+    """pyarrow's streaming reader needs unique column names and a byte-oriented encoding"""
+    return pa_csv is not None and encoding != "utf-16" and len(set(columns)) == len(columns)
+
+
+def iter_csv_chunks(csv_path, encoding, delimiter, columns, info=None):
+    """
+    Yield DataFrame chunks with every column read as string.
+    Uses pyarrow's streaming reader when installed, pandas' C engine otherwise.
+    pyarrow rejects rows with a different column count, which pandas pads with
+    NaN, so on such a row the rest of the file is read with pandas. The engine(s)
+    used are recorded in info["engine"] when a dict is passed.
+    """
+    info = info if info is not None else {}
+    rows_read = 0
+    if _use_pyarrow(encoding, columns):
+        info["engine"] = "pyarrow"
+        try:
+            with open_source(csv_path) as f:
+                reader = pa_csv.open_csv(
+                    f,
+                    read_options=pa_csv.ReadOptions(encoding=encoding, column_names=columns, skip_rows=1),
+                    parse_options=pa_csv.ParseOptions(delimiter=delimiter),
+                    convert_options=pa_csv.ConvertOptions(column_types={c: pa.string() for c in columns}),
+                )
+                for batch in reader:
+                    rows_read += batch.num_rows
+                    yield batch.to_pandas()
+            return
+        except pa.ArrowInvalid as e:
+            print(f"   pyarrow stopped at row {rows_read + 1} of {source_name(csv_path)} ({e}); continuing with pandas")
+            info["engine"] = "pyarrow+pandas" if rows_read else "pandas"
+    else:
+        info["engine"] = "pandas"
+
+    with open_source(csv_path) as f:
+        for chunk in pd.read_csv(
+            f,
+            sep=delimiter,
+            encoding=encoding,
+            engine="c",
+            dtype=str,
+            chunksize=CSV_CHUNK_ROWS,
+            skiprows=range(1, rows_read + 1) if rows_read else None,
+        ):
+            yield chunk
+
+
+def _update_column_stats(stats, chunk):
+    """Fold one chunk into running per-column statistics"""
+    for col in chunk.columns:
+        col_stats = stats.setdefault(col, {
+            "non_null": 0, "numeric": 0, "min": None, "max": None,
+            "sum": 0.0, "sum_sq": 0.0, "values": {}
+        })
+        values = chunk[col].dropna()
+        values = values[values.str.strip() != ""]
+        col_stats["non_null"] += len(values)
+
+        numbers = pd.to_numeric(values, errors="coerce").dropna()
+        if len(numbers):
+            col_stats["numeric"] += len(numbers)
+            col_min, col_max = float(numbers.min()), float(numbers.max())
+            col_stats["min"] = col_min if col_stats["min"] is None else min(col_stats["min"], col_min)
+            col_stats["max"] = col_max if col_stats["max"] is None else max(col_stats["max"], col_max)
+            col_stats["sum"] += float(numbers.sum())
+            col_stats["sum_sq"] += float((numbers ** 2).sum())
+
+        tracked = col_stats["values"]
+        if tracked is not None:
+            for value, count in values.value_counts().items():
+                tracked[value] = tracked.get(value, 0) + int(count)
+            if len(tracked) > CSV_MAX_TRACKED_VALUES:
+                col_stats["values"] = None  # Too many distinct values to be useful
+
+
+def _finalize_column_stats(stats, row_count):
+    """Turn running statistics into a compact per-column summary"""
+    summary = {}
+    for col, s in stats.items():
+        col_summary = {"non_null": s["non_null"], "missing": row_count - s["non_null"]}
+        # Mostly numeric columns get numeric stats, the rest get value counts
+        if s["numeric"] and s["numeric"] >= 0.8 * s["non_null"]:
+            mean = s["sum"] / s["numeric"]
+            variance = max(0.0, s["sum_sq"] / s["numeric"] - mean ** 2)
+            col_summary.update({
+                "type": "numeric",
+                "min": s["min"],
+                "max": s["max"],
+                "mean": round(mean, 4),
+                "std": round(variance ** 0.5, 4)
+            })
+        else:
+            col_summary["type"] = "text"
+            if s["values"] is not None:
+                col_summary["values"] = dict(sorted(s["values"].items(), key=lambda kv: -kv[1]))
+            else:
+                col_summary["distinct"] = f">{CSV_MAX_TRACKED_VALUES}"
+        summary[col] = col_summary
+    return summary
+
+
+def _summarize_chunks(chunks):
+    """Fold string-typed DataFrame chunks into (head, row_count, column_stats)"""
+    row_count = 0
+    head = None
+    stats = {}
+    for chunk in chunks:
+        if head is None:
+            head = chunk.head(CSV_HEAD_ROWS)
+        row_count += len(chunk)
+        _update_column_stats(stats, chunk)
+    return head, row_count, _finalize_column_stats(stats, row_count)
+
+
+def _csv_summary_result(csv_path, summary, mode):
+    """Bounded lab result (head rows + column stats) for a long table"""
+    text = (
+        f"CSV file summarized: {source_name(csv_path)}\n"
+        f"Rows: {summary['row_count']}, Columns: {len(summary['columns'])}\n"
+        f"First {len(summary['head'])} rows:\n{summary['head'].to_string()}\n"
+        f"Column statistics:\n{json.dumps(summary['column_stats'], indent=2)}"
+    )
+    return {
+        "text": text,
+        "tables": [summary["head"].to_dict(orient="records")],
+        "column_stats": summary["column_stats"],
+        "metadata": {
+            "source_file": source_name(csv_path),
+            "type": "csv",
+            "mode": mode,
+            "shape": (summary["row_count"], len(summary["columns"])),
+            "encoding": summary["encoding"],
+            "delimiter": summary["delimiter"],
+            "engine": summary["engine"],
+            "seconds": summary["seconds"],
+            "rows_per_second": summary["rows_per_second"]
+        }
+    }
+
+
+def summarize_csv_stream(csv_path):
+    """
+    Stream a delimited file in chunks and build a bounded summary
+    (schema, row count, head, per-column stats) instead of loading it whole.
+    """
+    start = time.perf_counter()
+    encoding, delimiter, columns = sniff_csv_format(csv_path)
+
+    reader_info = {}
+    head, row_count, column_stats = _summarize_chunks(
+        iter_csv_chunks(csv_path, encoding, delimiter, columns, reader_info)
+    )
+
+    elapsed = time.perf_counter() - start
+    head = head if head is not None else pd.DataFrame(columns=columns)
+    rows_per_second = row_count / elapsed if elapsed > 0 else float(row_count)
+    engine = reader_info.get("engine", "pandas")
+
+    return {
+        "columns": list(head.columns),
+        "row_count": row_count,
+        "head": head,
+        "column_stats": column_stats,
+        "encoding": encoding,
+        "delimiter": delimiter,
+        "engine": engine,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(rows_per_second, 1)
+    }
+
+
 # ---------------- 🧾 SIMPLIFIED PDF PROCESSING ----------------
 def extract_lab_data_from_pdf(pdf_path, tables_dir, images_dir):
     """
@@ -48,7 +355,7 @@ def extract_lab_data_from_pdf(pdf_path, tables_dir, images_dir):
     """
     file_type = get_file_type(pdf_path)
     if file_type != 'pdf':
-        print(f"Warning: File {pdf_path} is not a PDF (detected as {file_type})")
+        print(f"Warning: File {source_name(pdf_path)} is not a PDF (detected as {file_type})")
         if file_type == 'csv':
             return process_csv_file(pdf_path, tables_dir)
         else:
@@ -57,22 +364,61 @@ def extract_lab_data_from_pdf(pdf_path, tables_dir, images_dir):
     return extract_text_with_pdfplumber(pdf_path, tables_dir, images_dir)
 
 
-def process_csv_file(csv_path, tables_dir):
-    """Process CSV files directly"""
+def process_csv_file(csv_path, tables_dir, streaming=None):
+    """
+    Process CSV/TSV files directly.
+    Files above CSV_STREAMING_THRESHOLD_BYTES (or with streaming=True) are read in
+    chunks; smaller files are loaded whole. Either way, tables longer than
+    CSV_FULL_MAX_ROWS are reported as a bounded summary (head rows + column
+    stats) rather than in full. The processed table is saved to tables_dir
+    unless it is None.
+    """
+    if streaming is None:
+        streaming = source_size(csv_path) > CSV_STREAMING_THRESHOLD_BYTES
+
     try:
-        df = pd.read_csv(csv_path)
+        if streaming:
+            summary = summarize_csv_stream(csv_path)
+            print(f"   Streamed {summary['row_count']} rows at {summary['rows_per_second']:.0f} rows/s ({summary['engine']})")
+            return _csv_summary_result(csv_path, summary, "streaming")
+
+        start = time.perf_counter()
+        encoding, delimiter, _ = sniff_csv_format(csv_path)
+        with open_source(csv_path) as f:
+            df = pd.read_csv(f, sep=delimiter, encoding=encoding)
         
         # Save to tables directory
-        output_path = os.path.join(tables_dir, f"processed_{os.path.basename(csv_path)}")
-        df.to_csv(output_path, index=False)
+        if tables_dir:
+            output_path = os.path.join(tables_dir, f"processed_{source_name(csv_path)}")
+            df.to_csv(output_path, index=False)
+
+        if len(df) > CSV_FULL_MAX_ROWS:
+            _, row_count, column_stats = _summarize_chunks([df.astype("string")])
+            elapsed = time.perf_counter() - start
+            summary = {
+                "columns": list(df.columns),
+                "row_count": row_count,
+                "head": df.head(CSV_HEAD_ROWS),
+                "column_stats": column_stats,
+                "encoding": encoding,
+                "delimiter": delimiter,
+                "engine": "pandas",
+                "seconds": round(elapsed, 3),
+                "rows_per_second": round(row_count / elapsed, 1) if elapsed > 0 else float(row_count)
+            }
+            print(f"   Summarized {row_count} rows at {summary['rows_per_second']:.0f} rows/s")
+            return _csv_summary_result(csv_path, summary, "summary")
         
         return {
-            "text": f"CSV file processed: {os.path.basename(csv_path)}\n" + df.to_string(),
+            "text": f"CSV file processed: {source_name(csv_path)}\n" + df.to_string(),
             "tables": [df.to_dict(orient="records")],
             "metadata": {
-                "source_file": os.path.basename(csv_path),
+                "source_file": source_name(csv_path),
                 "type": "csv",
-                "shape": df.shape
+                "mode": "full",
+                "shape": df.shape,
+                "encoding": encoding,
+                "delimiter": delimiter
             }
         }
     except Exception as e:
@@ -80,7 +426,7 @@ def process_csv_file(csv_path, tables_dir):
             "text": f"Error processing CSV: {str(e)}",
             "tables": [],
             "metadata": {
-                "source_file": os.path.basename(csv_path),
+                "source_file": source_name(csv_path),
                 "error": str(e)
             }
         }
@@ -88,13 +434,14 @@ def process_csv_file(csv_path, tables_dir):
 
 def extract_text_with_pdfplumber(pdf_path, tables_dir, images_dir):
     """
-    Extract text and tables from PDF using pdfplumber
+    Extract text and tables from PDF using pdfplumber.
+    Tables and images are saved to tables_dir/images_dir unless they are None.
     """
     try:
         all_text = []
         all_tables = []
         
-        with pdfplumber.open(pdf_path) as pdf:
+        with open_source(pdf_path) as pdf_file, pdfplumber.open(pdf_file) as pdf:
             for page_num, page in enumerate(pdf.pages, 1):
                 # Extract text
                 text = page.extract_text()
@@ -140,20 +487,21 @@ def extract_text_with_pdfplumber(pdf_path, tables_dir, images_dir):
                                 df.columns = [str(col).strip() for col in df.columns]
                                 
                                 if not df.empty and len(df.columns) > 0:
-                                    csv_name = os.path.join(
-                                        tables_dir, 
-                                        f"table_page{page_num}_table{table_num+1}.csv"
-                                    )
-                                    df.to_csv(csv_name, index=False)
                                     all_tables.append(df.to_dict(orient="records"))
-                                    print(f"Saved table: {csv_name}")
+                                    if tables_dir:
+                                        csv_name = os.path.join(
+                                            tables_dir, 
+                                            f"table_page{page_num}_table{table_num+1}.csv"
+                                        )
+                                        df.to_csv(csv_name, index=False)
+                                        print(f"Saved table: {csv_name}")
                                     
                         except Exception as e:
                             print(f"Table extraction failed for page {page_num}, table {table_num}: {e}")
                 
                 # Extract images if any
                 try:
-                    if hasattr(page, 'images') and page.images:
+                    if images_dir and hasattr(page, 'images') and page.images:
                         for img_index, img in enumerate(page.images):
                             try:
                                 # Extract image using pdfplumber's method
@@ -173,7 +521,7 @@ def extract_text_with_pdfplumber(pdf_path, tables_dir, images_dir):
             "text": full_text,
             "tables": all_tables,
             "metadata": {
-                "source_pdf": os.path.basename(pdf_path),
+                "source_pdf": source_name(pdf_path),
                 "method": "pdfplumber",
                 "pages_processed": len(all_text),
                 "tables_extracted": len(all_tables)
@@ -186,7 +534,7 @@ def extract_text_with_pdfplumber(pdf_path, tables_dir, images_dir):
             "text": f"Error: Could not extract text from PDF: {str(e)}",
             "tables": [],
             "metadata": {
-                "source_pdf": os.path.basename(pdf_path),
+                "source_pdf": source_name(pdf_path),
                 "error": str(e)
             }
         }
@@ -194,30 +542,160 @@ def extract_text_with_pdfplumber(pdf_path, tables_dir, images_dir):
 
 # ---------------- 🩻 X-RAY ANALYSIS ----------------
 def encode_image(image_path):
-    """Encode image to base64 with better error handling"""
+    """Encode image (path or in-memory source) to base64 with better error handling"""
     try:
         # Verify file exists and is readable
-        if not os.path.exists(image_path):
-            raise FileNotFoundError(f"Image file not found: {image_path}")
+        if not source_exists(image_path):
+            raise FileNotFoundError(f"Image file not found: {source_name(image_path)}")
         
         # Check file size (avoid very large files)
-        file_size = os.path.getsize(image_path)
+        file_size = source_size(image_path)
         if file_size > 10 * 1024 * 1024:  # 10MB limit
-            print(f"Warning: Large image file ({file_size / (1024*1024):.1f}MB): {image_path}")
+            print(f"Warning: Large image file ({file_size / (1024*1024):.1f}MB): {source_name(image_path)}")
         
-        with open(image_path, "rb") as img_file:
-            encoded = base64.b64encode(img_file.read()).decode("utf-8")
-            return encoded
+        return base64.b64encode(read_source(image_path)).decode("utf-8")
             
     except Exception as e:
-        print(f"Error encoding image {image_path}: {e}")
+        print(f"Error encoding image {source_name(image_path)}: {e}")
         return None
 
 
-def describe_xray_with_groq(image_path):
-    """X-ray analysis using Groq vision model"""
-    if not os.path.exists(image_path):
-        return f"Error: Image file not found: {image_path}"
+# ---------------- 🩻 X-RAY TRIAGE ----------------
+MIN_XRAY_DIMENSION = 256          # Smaller images are thumbnails/icons, not films
+MIN_XRAY_ENTROPY = 2.0            # Bits; below this the image is (nearly) blank
+MAX_XRAY_COLOR_SPREAD = 12.0      # Mean per-pixel channel spread (0-255) for grayscale films
+PHASH_DUPLICATE_DISTANCE = 6      # Max Hamming distance (of 64 bits) for a near-duplicate
+RECENT_STUDY_INDEX_SIZE = 256
+
+# (scope, phash) -> {"scope", "phash", "sha256", "file", "description"}, most recent last.
+# A scope is one patient ("patient:<id>") or one request ("request:<uuid>");
+# perceptual near-duplicates are only reused within a scope, and across
+# scopes only byte-identical images are.
+recent_xray_studies = OrderedDict()
+
+
+def _dct_matrix(n):
+    """Orthonormal DCT-II basis matrix"""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    mat = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    mat[0, :] = np.sqrt(1.0 / n)
+    return mat
+
+
+_DCT_32 = _dct_matrix(32)
+
+
+def _to_8bit(img):
+    """
+    8-bit grayscale view of high bit-depth images (modes I;16*, I, F),
+    stretched to the image's own min/max; convert() would clip them at 255
+    """
+    if not (img.mode.startswith("I") or img.mode == "F"):
+        return img
+    pixels = np.asarray(img, dtype=np.float64)
+    low, high = float(pixels.min()), float(pixels.max())
+    scaled = (pixels - low) * (255.0 / (high - low)) if high > low else np.zeros_like(pixels)
+    return Image.fromarray(scaled.round().astype(np.uint8), "L")
+
+
+def compute_phash(img):
+    """64-bit perceptual hash (DCT of a 32x32 grayscale thumbnail)"""
+    small = np.asarray(img.convert("L").resize((32, 32), Image.LANCZOS), dtype=np.float64)
+    dct = _DCT_32 @ small @ _DCT_32.T
+    low = dct[:8, :8].flatten()
+    bits = low > np.median(low[1:])
+    return int("".join("1" if b else "0" for b in bits), 2)
+
+
+def find_recent_study(phash, sha256, scope):
+    """
+    Return (study, distance, same_scope) for a reusable recent study: the closest
+    near-duplicate within the same scope, else a byte-identical image from any scope.
+    """
+    best, best_distance, exact = None, None, None
+    for study in recent_xray_studies.values():
+        if study["scope"] == scope:
+            distance = bin(study["phash"] ^ phash).count("1")
+            if distance <= PHASH_DUPLICATE_DISTANCE and (best_distance is None or distance < best_distance):
+                best, best_distance = study, distance
+        elif exact is None and study["sha256"] == sha256:
+            exact = study
+
+    if best is None and exact is not None:
+        best, best_distance = exact, 0
+    if best is not None:
+        recent_xray_studies.move_to_end((best["scope"], best["phash"]))
+    return best, best_distance, best is not None and best["scope"] == scope
+
+
+def remember_study(phash, sha256, scope, file_name, description):
+    """Add a described study to the recent index"""
+    key = (scope, phash)
+    recent_xray_studies[key] = {
+        "scope": scope, "phash": phash, "sha256": sha256,
+        "file": file_name, "description": description
+    }
+    recent_xray_studies.move_to_end(key)
+    while len(recent_xray_studies) > RECENT_STUDY_INDEX_SIZE:
+        recent_xray_studies.popitem(last=False)
+
+
+def triage_xray_image(image_path):
+    """
+    Local checks before spending a vision call: decodability, dimensions,
+    blankness (histogram entropy) and grayscale likelihood.
+    Returns a dict with "ok", "reason" and the measured values.
+    """
+    triage = {"ok": False, "reason": None}
+    try:
+        with open_source(image_path) as f, Image.open(f) as img:
+            img.verify()
+        with open_source(image_path) as f, Image.open(f) as img:
+            img.load()
+            width, height = img.size
+            triage.update({"width": width, "height": height, "mode": img.mode})
+
+            if min(width, height) < MIN_XRAY_DIMENSION:
+                triage["reason"] = f"Image too small ({width}x{height}px, minimum {MIN_XRAY_DIMENSION}px)"
+                return triage
+
+            # Work on a bounded thumbnail; stats are scale-invariant enough
+            thumb = _to_8bit(img).convert("RGB")
+            thumb.thumbnail((512, 512))
+    except Exception as e:
+        triage["reason"] = f"Image could not be decoded: {e}"
+        return triage
+
+    rgb = np.asarray(thumb, dtype=np.int16)
+    gray = np.asarray(thumb.convert("L"))
+
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    prob = hist[hist > 0] / hist.sum()
+    entropy = max(0.0, float(-(prob * np.log2(prob)).sum()))
+    color_spread = float((rgb.max(axis=2) - rgb.min(axis=2)).mean())
+    triage.update({"entropy": round(entropy, 3), "color_spread": round(color_spread, 2)})
+
+    if entropy < MIN_XRAY_ENTROPY:
+        triage["reason"] = f"Image appears blank (entropy {entropy:.2f} bits)"
+        return triage
+    if color_spread > MAX_XRAY_COLOR_SPREAD:
+        triage["reason"] = f"Image is not grayscale (color spread {color_spread:.1f}); likely not a radiograph"
+        return triage
+
+    triage["phash"] = f"{compute_phash(thumb):016x}"
+    triage["sha256"] = hashlib.sha256(read_source(image_path)).hexdigest()
+    triage["ok"] = True
+    return triage
+
+
+def describe_xray_with_groq(image_path, phash=None, sha256=None, scope=None):
+    """
+    X-ray analysis using Groq vision model.
+    Successful descriptions are added to the recent study index when a phash is given.
+    """
+    if not source_exists(image_path):
+        return f"Error: Image file not found: {source_name(image_path)}"
     
     try:
         image_base64 = encode_image(image_path)
@@ -266,18 +744,22 @@ IMPORTANT:
             temperature=0.1,
             max_tokens=1000
         )
-        return response.choices[0].message.content
+        description = response.choices[0].message.content
+        if phash is not None:
+            remember_study(phash, sha256, scope, source_name(image_path), description)
+        return description
         
     except Exception as e:
         print(f"Groq Vision error: {e}")
         # Fallback: basic image info
         try:
-            img = Image.open(image_path)
+            with open_source(image_path) as f, Image.open(f) as img:
+                size, mode = img.size, img.mode
             return f"""Image Analysis Fallback:
-- File: {os.path.basename(image_path)}
-- Dimensions: {img.size[0]} x {img.size[1]} pixels
-- Color Mode: {img.mode}
-- File Size: {os.path.getsize(image_path) / 1024:.1f} KB
+- File: {source_name(image_path)}
+- Dimensions: {size[0]} x {size[1]} pixels
+- Color Mode: {mode}
+- File Size: {source_size(image_path) / 1024:.1f} KB
 - Error: {str(e)}
 
 Note: Unable to perform AI analysis due to technical error."""
@@ -285,9 +767,347 @@ Note: Unable to perform AI analysis due to technical error."""
             return f"Complete image analysis failure: {str(img_error)}"
 
 
+# ---------------- 📈 LONGITUDINAL LAB HISTORY ----------------
+HISTORY_DIR = "./patient_history"
+TREND_POINTS = 3                  # Most recent values shown per analyte
+
+LAB_COLUMN_ALIASES = {
+    "analyte": ["test", "test name", "analyte", "parameter", "investigation", "component"],
+    "value": ["result", "value", "observed value", "result value"],
+    "unit": ["unit", "units"],
+    "reference": ["biological ref. interval", "reference range", "ref. range", "reference", "normal range"],
+    "date": ["date", "collection date", "collected", "collected on", "sample date"],
+}
+DATE_PATTERN = re.compile(r"(?:collect\w*|sample\w*)[^\n]{0,40}?(\d{4}-\d{2}-\d{2}|\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4})", re.I)
+NUMBER_PATTERN = re.compile(r"-?\d+(?:\.\d+)?")
+LAB_DATE_DAYFIRST = True          # 03/04/2024 is 3 April (report locale); unambiguous dates parse either way
+ISO_DATE_FORMATS = ["%Y-%m-%d", "%Y/%m/%d"]
+DAYFIRST_DATE_FORMATS = ["%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y", "%d/%m/%y", "%d-%m-%y",
+                         "%d-%b-%Y", "%d %b %Y", "%d-%b-%y", "%d %B %Y"]
+MONTHFIRST_DATE_FORMATS = ["%m/%d/%Y", "%m-%d-%Y", "%m.%d.%Y", "%m/%d/%y", "%m-%d-%y",
+                           "%b %d %Y", "%b %d, %Y", "%B %d, %Y"]
+
+
+def normalize_lab_date(value):
+    """ISO (YYYY-MM-DD) form of a lab date string, or None if it can't be parsed"""
+    text = str(value or "").strip()
+    if not text:
+        return None
+    preferred, other = ((DAYFIRST_DATE_FORMATS, MONTHFIRST_DATE_FORMATS) if LAB_DATE_DAYFIRST
+                        else (MONTHFIRST_DATE_FORMATS, DAYFIRST_DATE_FORMATS))
+    # Try the whole cell, then just its date part ("12/01/2023 10:30", "2024-01-05T08:00")
+    candidates = [text, re.split(r"[\sT]", text, maxsplit=1)[0]]
+    for formats in (ISO_DATE_FORMATS + preferred, other):
+        for candidate in candidates:
+            for fmt in formats:
+                try:
+                    return datetime.strptime(candidate, fmt).date().isoformat()
+                except ValueError:
+                    continue
+    return None
+
+
+def parse_collection_date(value):
+    """
+    Validate a caller-supplied collection date. Accepts a date or an ISO
+    (YYYY-MM-DD) string and returns the ISO string; raises ValueError otherwise.
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, date):
+        return value.isoformat()
+    try:
+        return date.fromisoformat(str(value).strip()).isoformat()
+    except ValueError:
+        raise ValueError(f"Invalid collection_date '{value}'. Expected YYYY-MM-DD") from None
+
+
+def _history_path(patient_id):
+    safe_id = re.sub(r"[^A-Za-z0-9_.-]", "_", str(patient_id))
+    return os.path.join(HISTORY_DIR, f"{safe_id}.json")
+
+
+@contextmanager
+def patient_history_lock(patient_id):
+    """
+    Exclusive per-patient lock (flock on a sidecar file) for a history
+    load -> diff -> save cycle, so concurrent requests or workers don't
+    overwrite each other's rows. Without fcntl (Windows) there is no
+    cross-process lock: run a single worker there.
+    """
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    with open(f"{_history_path(patient_id)}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def load_patient_history(patient_id):
+    """Load a patient's stored lab rows ({"results": {key: row}, "file_hashes": [...]})"""
+    try:
+        with open(_history_path(patient_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"patient_id": patient_id, "results": {}, "file_hashes": []}
+
+
+def save_patient_history(patient_id, history):
+    """Atomically write a patient's lab history"""
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    path = _history_path(patient_id)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(history, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _match_lab_columns(columns):
+    """Map canonical fields (analyte, value, ...) to a table's column names"""
+    matched = {}
+    for col in columns:
+        name = str(col).strip().lower()
+        for field, aliases in LAB_COLUMN_ALIASES.items():
+            if field not in matched and name in aliases:
+                matched[field] = col
+    return matched
+
+
+def _cell(record, column):
+    """Stripped string value of a table cell; missing/NaN cells become ''"""
+    value = record.get(column) if column is not None else None
+    if value is None or (isinstance(value, float) and value != value):
+        return ""
+    return str(value).strip()
+
+
+def extract_lab_rows(tables, text="", collection_date=None):
+    """
+    Pull (analyte, value, unit, reference, date) rows out of a lab file's tables.
+    Each row is dated by its own date column, else by the report's "Collected"
+    date, else by collection_date; dates are normalized to ISO and rows with no
+    date from any source get date None. A file listing an analyte more than once
+    without row dates is a cumulative export, and its rows are flagged
+    "cumulative" - the file-level date only applies to the rows it added.
+    Returns (rows, unstructured_tables) - tables without analyte/value columns
+    are returned untouched.
+    """
+    text_date = DATE_PATTERN.search(text or "")
+    file_date = (normalize_lab_date(text_date.group(1)) if text_date else None) or collection_date
+
+    rows, unstructured = [], []
+    undated_counts = {}
+    for table in tables:
+        if not table:
+            continue
+        columns = _match_lab_columns(table[0].keys())
+        if "analyte" not in columns or "value" not in columns:
+            unstructured.append(table)
+            continue
+
+        for record in table:
+            analyte = _cell(record, columns["analyte"])
+            value = _cell(record, columns["value"])
+            if not analyte or not value or set(value) <= {"-"}:
+                continue
+            row_date = normalize_lab_date(_cell(record, columns.get("date")))
+            if row_date is None:
+                undated_counts[analyte.lower()] = undated_counts.get(analyte.lower(), 0) + 1
+            rows.append({
+                "analyte": analyte,
+                "value": value,
+                "unit": _cell(record, columns.get("unit")),
+                "reference": _cell(record, columns.get("reference")),
+                "date": row_date or file_date,
+                "own_date": row_date is not None
+            })
+
+    cumulative = any(count > 1 for count in undated_counts.values())
+    for row in rows:
+        row["cumulative"] = cumulative and not row.pop("own_date")
+    return rows, unstructured
+
+
+def _lab_tables(source, lab_result):
+    """
+    Tables to take longitudinal rows from. CSV lab reports are re-read in full
+    as strings (the lab result only carries the head rows of long tables);
+    other files use the tables already extracted.
+    """
+    if lab_result.get("metadata", {}).get("type") != "csv":
+        return lab_result.get("tables", [])
+    encoding, delimiter, columns = sniff_csv_format(source)
+    matched = _match_lab_columns(columns)
+    if "analyte" not in matched or "value" not in matched:
+        return lab_result.get("tables", [])
+    return (
+        chunk.to_dict(orient="records")
+        for chunk in iter_csv_chunks(source, encoding, delimiter, columns)
+    )
+
+
+def _lab_file_hash(source):
+    """Fingerprint a lab file by its raw bytes (not its upload name)"""
+    digest = hashlib.sha1()
+    with open_source(source) as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _stored_values_by_analyte(results):
+    """Stored rows per analyte, newest first - candidates for matching undated rows"""
+    by_analyte = {}
+    for row in sorted(results.values(), key=lambda r: r["date"], reverse=True):
+        by_analyte.setdefault(row["analyte"].lower(), []).append(row)
+    return by_analyte
+
+
+def diff_lab_history(patient_id, lab_files, collection_date=None):
+    """
+    Compare this request's lab rows with the patient's stored history.
+    lab_files is a list of (source, lab_result) pairs. Files already seen for
+    this patient (same bytes) are skipped outright. Dated rows are keyed by
+    analyte and date, so a repeated value on a new date is a new result. Rows
+    from cumulative exports, and rows with no date from any source, are instead
+    matched by analyte and value against stored results, newest first, each
+    stored result matching at most one row; only unmatched ones become new
+    results under the report/collection date (today if there is none).
+
+    Returns (lab_data, trends, stats, history): new or changed rows (at most
+    CSV_FULL_MAX_ROWS, newest first, plus column statistics and unstructured
+    tables from new files), a compact per-analyte trend summary, and the updated
+    history. Nothing is written - the caller saves the history with
+    save_patient_history() once the note has been generated, holding
+    patient_history_lock() from load to save.
+    """
+    collection_date = parse_collection_date(collection_date)
+    fallback_date = collection_date or date.today().isoformat()
+    history = load_patient_history(patient_id)
+    results = history["results"]
+    seen_files = set(history["file_hashes"])
+    unmatched_stored = _stored_values_by_analyte(results)
+
+    new_rows, changed_rows, unstructured_tables = [], [], []
+    column_stats = {}
+    unchanged = files_skipped = 0
+    for source, lab in lab_files:
+        if lab.get("metadata", {}).get("error"):
+            continue
+        file_hash = _lab_file_hash(source)
+        if file_hash in seen_files:
+            files_skipped += 1
+            continue
+        seen_files.add(file_hash)
+
+        rows, unstructured = extract_lab_rows(_lab_tables(source, lab), lab.get("text", ""), collection_date)
+        unstructured_tables.extend(unstructured)
+        if lab.get("column_stats"):
+            column_stats[f"{source_name(source)}_column_stats"] = lab["column_stats"]
+        for row in rows:
+            if row.pop("cumulative") or row["date"] is None:
+                candidates = unmatched_stored.get(row["analyte"].lower(), [])
+                match = next((c for c in candidates if c["value"] == row["value"]), None)
+                if match is not None:
+                    candidates.remove(match)
+                    unchanged += 1
+                    continue
+                row["date"] = row["date"] or fallback_date
+
+            key = f"{row['analyte'].lower()}|{row['date']}"
+            previous = results.get(key)
+            if previous is None:
+                new_rows.append(row)
+            elif previous["value"] != row["value"]:
+                changed_rows.append({**row, "previous_value": previous["value"]})
+            else:
+                unchanged += 1
+                continue
+            results[key] = row
+
+    history["file_hashes"] = sorted(seen_files)
+
+    # Trends only for analytes touched by this request
+    touched = {row["analyte"].lower() for row in new_rows + changed_rows}
+    trends = {}
+    for row in sorted(results.values(), key=lambda r: r["date"]):
+        if row["analyte"].lower() in touched:
+            trends.setdefault(row["analyte"], []).append(row)
+    trend_summary = {}
+    for analyte, points in trends.items():
+        if len(points) < 2:
+            continue
+        recent = points[-TREND_POINTS:]
+        values = [NUMBER_PATTERN.search(p["value"]) for p in recent]
+        line = " -> ".join(f"{p['value']} ({p['date']})" for p in recent)
+        if values[0] and values[-1]:
+            delta = float(values[-1].group()) - float(values[0].group())
+            line += f"; change {delta:+g} {recent[-1]['unit']}".rstrip()
+        trend_summary[analyte] = f"{line}; {len(points)} results on file"
+
+    # Bound what goes to the model; everything is still stored
+    lab_data = {}
+    for label, label_rows in (("New_Results", new_rows), ("Changed_Results", changed_rows)):
+        if len(label_rows) > CSV_FULL_MAX_ROWS:
+            label_rows = sorted(label_rows, key=lambda r: r["date"], reverse=True)
+            lab_data[f"{label}_omitted"] = len(label_rows) - CSV_FULL_MAX_ROWS
+            label_rows = label_rows[:CSV_FULL_MAX_ROWS]
+        if label_rows:
+            lab_data[label] = label_rows
+    lab_data.update(column_stats)
+    for i, table in enumerate(unstructured_tables):
+        lab_data[f"Table_{i+1}"] = table
+
+    stats = {
+        "patient_id": patient_id,
+        "new": len(new_rows),
+        "changed": len(changed_rows),
+        "unchanged": unchanged,
+        "files_skipped": files_skipped,
+        "results_on_file": len(results),
+        "saved": False
+    }
+    return lab_data, trend_summary, stats, history
+
+
 # ---------------- 🧠 SOAP NOTE GENERATION ----------------
-def generate_soap_note(lab_data, xray_description, subjective_note=None):
-    """Generate SOAP note with improved structure and error handling"""
+LAB_FALLBACK_MAX_CHARS = 1000
+FALLBACK_ASSESSMENT_PREFIX = "Unable to generate assessment"
+
+
+def summarize_lab_data(lab_data, max_chars=LAB_FALLBACK_MAX_CHARS):
+    """Short description of the lab data for fallback notes (not a full dump)"""
+    if not lab_data:
+        return "No lab results provided"
+    if isinstance(lab_data, dict):
+        parts = [
+            f"{key} ({len(value)} rows)" if isinstance(value, (list, dict)) else f"{key}: {value}"
+            for key, value in lab_data.items()
+        ]
+        summary = "Lab data received but not interpreted: " + ", ".join(parts)
+    else:
+        summary = f"Lab data received but not interpreted: {lab_data}"
+    if len(summary) > max_chars:
+        summary = summary[:max_chars].rstrip() + "..."
+    return summary
+
+
+def is_fallback_note(soap_note):
+    """True if generate_soap_note() fell back to its placeholder note (or failed)"""
+    if not isinstance(soap_note, dict) or "error" in soap_note:
+        return True
+    return str(soap_note.get("Assessment", "")).startswith(FALLBACK_ASSESSMENT_PREFIX)
+
+
+def generate_soap_note(lab_data, xray_description, subjective_note=None, lab_trends=None):
+    """
+    Generate SOAP note with improved structure and error handling.
+    lab_trends, when given, is a per-analyte summary of the patient's prior results.
+    """
     subjective_note = subjective_note or "Patient presents with chief complaint requiring clinical evaluation."
     
     # Process lab data more intelligently
@@ -298,6 +1118,11 @@ def generate_soap_note(lab_data, xray_description, subjective_note=None):
     else:
         lab_str = str(lab_data)
 
+    trends_section = ""
+    if lab_trends:
+        trends_str = "\n".join(f"- {analyte}: {trend}" for analyte, trend in lab_trends.items())
+        trends_section = f"\nLaboratory Trends (prior visits, oldest to newest):\n{trends_str}\n"
+
     prompt = f"""You are a medical professional creating a SOAP note. Based on the provided information, generate a comprehensive but concise SOAP note.
 
 **SUBJECTIVE:**
@@ -306,7 +1131,7 @@ def generate_soap_note(lab_data, xray_description, subjective_note=None):
 **OBJECTIVE DATA:**
 Laboratory Results:
 {lab_str}
-
+{trends_section}
 Imaging Findings:
 {xray_description}
 
@@ -369,10 +1194,10 @@ Imaging Findings:
             "Objective": {
                 "Vital_Signs": "Not documented",
                 "Physical_Examination": "Not documented",
-                "Laboratory_Results": str(lab_data) if lab_data else "No lab results provided",
+                "Laboratory_Results": summarize_lab_data(lab_data),
                 "Imaging_Studies": xray_description or "No imaging studies provided"
             },
-            "Assessment": f"Unable to generate assessment due to processing error: {str(e)}",
+            "Assessment": f"{FALLBACK_ASSESSMENT_PREFIX} due to processing error: {str(e)}",
             "Plan": {
                 "Immediate": "Review all available data",
                 "Follow_up": "Clinical correlation recommended",
@@ -383,46 +1208,57 @@ Imaging Findings:
 
 
 # ---------------- 🚀 MAIN PIPELINE ----------------
-def run_pipeline(text_input=None, text_file=None, lab_files=None, xray_files=None):
+def run_pipeline(text_input=None, text_file=None, lab_files=None, xray_files=None,
+                 patient_id=None, collection_date=None, save_artifacts=True):
     """
-    Main pipeline with simplified PDF processing using only pdfplumber
+    Main pipeline with simplified PDF processing using only pdfplumber.
+    Files may be paths or in-memory sources (see INPUT SOURCES); with
+    save_artifacts=False extracted tables/images are not written to disk.
+    With a patient_id, only lab results that are new or changed since the
+    patient's previous notes are sent to the model, plus a trend summary;
+    the patient's history is only updated once a note has been generated.
+    Raises ValueError for a collection_date that is not YYYY-MM-DD.
     """
+    collection_date = parse_collection_date(collection_date)
     lab_files = lab_files or []
     xray_files = xray_files or []
 
     # Initialize results
     lab_analysis = []
+    lab_sources = []  # Source of each lab_analysis entry
     xray_findings = []
     combined_text = text_input or ""
 
     # Process text file
-    if text_file and os.path.exists(text_file):
+    if text_file and source_exists(text_file):
         try:
-            with open(text_file, "r", encoding="utf-8") as f:
-                file_content = f.read()
-                combined_text += f"\n\n--- Content from {os.path.basename(text_file)} ---\n{file_content}"
+            file_content = read_source(text_file).decode("utf-8").replace("\r\n", "\n")
+            combined_text += f"\n\n--- Content from {source_name(text_file)} ---\n{file_content}"
         except Exception as e:
-            print(f"Error reading text file {text_file}: {e}")
+            print(f"Error reading text file {source_name(text_file)}: {e}")
 
     # Create output directories
-    os.makedirs("./tables", exist_ok=True)
-    os.makedirs("./images", exist_ok=True)
+    tables_dir = images_dir = None
+    if save_artifacts:
+        tables_dir, images_dir = "./tables", "./images"
+        os.makedirs(tables_dir, exist_ok=True)
+        os.makedirs(images_dir, exist_ok=True)
 
     # Process lab files (PDFs and CSVs)
     for lab_path in lab_files:
-        if not os.path.exists(lab_path):
-            print(f"Warning: Lab file not found: {lab_path}")
+        if not source_exists(lab_path):
+            print(f"Warning: Lab file not found: {source_name(lab_path)}")
             continue
             
-        print(f"📄 Processing lab file: {lab_path}")
+        print(f"📄 Processing lab file: {source_name(lab_path)}")
         file_type = get_file_type(lab_path)
         print(f"   Detected file type: {file_type}")
         
         try:
             if file_type == 'pdf':
-                lab_result = extract_lab_data_from_pdf(lab_path, "./tables", "./images")
+                lab_result = extract_lab_data_from_pdf(lab_path, tables_dir, images_dir)
             elif file_type == 'csv':
-                lab_result = process_csv_file(lab_path, "./tables")
+                lab_result = process_csv_file(lab_path, tables_dir)
             else:
                 lab_result = {
                     "text": f"Unsupported file type: {file_type}",
@@ -434,61 +1270,126 @@ def run_pipeline(text_input=None, text_file=None, lab_files=None, xray_files=Non
             print(f"   ✓ Processed successfully")
             
         except Exception as e:
-            print(f"   ✗ Error processing {lab_path}: {e}")
+            print(f"   ✗ Error processing {source_name(lab_path)}: {e}")
             lab_analysis.append({
-                "text": f"Error processing {os.path.basename(lab_path)}: {str(e)}",
+                "text": f"Error processing {source_name(lab_path)}: {str(e)}",
                 "tables": [],
-                "metadata": {"error": str(e), "source_file": os.path.basename(lab_path)}
+                "metadata": {"error": str(e), "source_file": source_name(lab_path)}
             })
+        lab_sources.append(lab_path)
 
-    # Process X-ray files
+    # Process X-ray files; near-duplicate reuse is limited to this patient (or this request)
+    study_scope = f"patient:{patient_id}" if patient_id else f"request:{uuid.uuid4().hex}"
     for xray_path in xray_files:
-        if not os.path.exists(xray_path):
-            print(f"Warning: X-ray file not found: {xray_path}")
+        if not source_exists(xray_path):
+            print(f"Warning: X-ray file not found: {source_name(xray_path)}")
             continue
             
-        print(f"🩻 Processing X-ray: {xray_path}")
+        print(f"🩻 Processing X-ray: {source_name(xray_path)}")
         try:
-            xray_result = describe_xray_with_groq(xray_path)
+            triage = triage_xray_image(xray_path)
+            if not triage["ok"]:
+                print(f"   ⏭ Skipped: {triage['reason']}")
+                xray_findings.append({
+                    "file": source_name(xray_path),
+                    "description": f"Skipped: {triage['reason']}",
+                    "path": _source_path(xray_path),
+                    "skipped": True,
+                    "reason": triage["reason"],
+                    "triage": triage
+                })
+                continue
+
+            phash = int(triage["phash"], 16)
+            study, distance, same_scope = find_recent_study(phash, triage["sha256"], study_scope)
+            if study:
+                if not same_scope:
+                    # Don't reveal another patient's/request's file name
+                    reason = "Byte-identical to an image described in another request"
+                elif patient_id:
+                    reason = f"Near-duplicate of {study['file']} from this patient's studies (hash distance {distance})"
+                else:
+                    reason = f"Near-duplicate of {study['file']} in this request (hash distance {distance})"
+                print(f"   ♻ Reused description: {reason}")
+                xray_findings.append({
+                    "file": source_name(xray_path),
+                    "description": study["description"],
+                    "path": _source_path(xray_path),
+                    "reused": True,
+                    "reason": reason,
+                    "triage": triage
+                })
+                continue
+
+            xray_result = describe_xray_with_groq(xray_path, phash=phash, sha256=triage["sha256"], scope=study_scope)
             xray_findings.append({
-                "file": os.path.basename(xray_path),
+                "file": source_name(xray_path),
                 "description": xray_result,
-                "path": xray_path
+                "path": _source_path(xray_path),
+                "triage": triage
             })
             print(f"   ✓ Analyzed successfully")
         except Exception as e:
-            print(f"   ✗ Error processing {xray_path}: {e}")
+            print(f"   ✗ Error processing {source_name(xray_path)}: {e}")
             xray_findings.append({
-                "file": os.path.basename(xray_path),
+                "file": source_name(xray_path),
                 "description": f"Error analyzing X-ray: {str(e)}",
-                "path": xray_path,
+                "path": _source_path(xray_path),
                 "error": str(e)
             })
 
     # Combine all findings for SOAP note generation
-    all_lab_data = {}
-    for lab in lab_analysis:
-        if lab.get("tables"):
-            for i, table in enumerate(lab["tables"]):
-                all_lab_data[f"Table_{i+1}"] = table
-
-    xray_text = "\n\n".join([
-        f"=== {x['file']} ===\n{x['description']}" 
-        for x in xray_findings
-    ])
-
-    # Generate SOAP note
-    print("📝 Generating SOAP note...")
-    try:
-        soap_note = generate_soap_note(
-            lab_data=all_lab_data,
-            xray_description=xray_text,
-            subjective_note=combined_text.strip() or None
-        )
-        print("   ✓ SOAP note generated successfully")
-    except Exception as e:
-        print(f"   ✗ SOAP note generation failed: {e}")
-        soap_note = {"error": f"SOAP generation failed: {str(e)}"}
+    with ExitStack() as history_lock:
+        all_lab_data = {}
+        lab_trends = None
+        longitudinal = None
+        pending_history = None
+        if patient_id:
+            # Held until the history is saved, so concurrent requests for this patient don't lose rows
+            history_lock.enter_context(patient_history_lock(patient_id))
+            all_lab_data, lab_trends, longitudinal, pending_history = diff_lab_history(
+                patient_id, list(zip(lab_sources, lab_analysis)), collection_date
+            )
+            print(f"   Lab history for {patient_id}: {longitudinal['new']} new, "
+                  f"{longitudinal['changed']} changed, {longitudinal['unchanged']} unchanged")
+        else:
+            for lab in lab_analysis:
+                if lab.get("tables"):
+                    for i, table in enumerate(lab["tables"]):
+                        all_lab_data[f"Table_{i+1}"] = table
+                if lab.get("column_stats"):
+                    # Streamed files only carry their head rows; add the full-file statistics
+                    source = lab.get("metadata", {}).get("source_file", f"File_{len(all_lab_data)+1}")
+                    all_lab_data[f"{source}_column_stats"] = lab["column_stats"]
+
+        xray_text = "\n\n".join([
+            f"=== {x['file']} ===\n{x['description']}" 
+            for x in xray_findings
+            if not x.get("skipped")
+        ])
+
+        # Generate SOAP note
+        print("📝 Generating SOAP note...")
+        try:
+            soap_note = generate_soap_note(
+                lab_data=all_lab_data,
+                xray_description=xray_text,
+                subjective_note=combined_text.strip() or None,
+                lab_trends=lab_trends
+            )
+            print("   ✓ SOAP note generated successfully")
+        except Exception as e:
+            print(f"   ✗ SOAP note generation failed: {e}")
+            soap_note = {"error": f"SOAP generation failed: {str(e)}"}
+
+        # Only record the lab rows once they have made it into a note; otherwise the
+        # next request would treat them as already reported
+        if pending_history is not None:
+            if is_fallback_note(soap_note):
+                print(f"   Lab history for {patient_id} not updated (no note generated)")
+            else:
+                save_patient_history(patient_id, pending_history)
+                longitudinal["saved"] = True
 
     # Compile results
     results = {
@@ -500,7 +1401,8 @@ def run_pipeline(text_input=None, text_file=None, lab_files=None, xray_files=Non
             },
             "processing_method": "pdfplumber_only",
             "lab_analysis": lab_analysis,
-            "xray_findings": xray_findings
+            "xray_findings": xray_findings,
+            "longitudinal": longitudinal
         },
         "soap_note": soap_note
     }
@@ -508,6 +1410,7 @@ def run_pipeline(text_input=None, text_file=None, lab_files=None, xray_files=Non
     print("\n🎉 Pipeline completed!")
     print(f"   Lab files processed: {len(lab_analysis)}")
     print(f"   X-ray files processed: {len(xray_findings)}")
+    print(f"   X-rays skipped/reused: {sum(1 for x in xray_findings if x.get('skipped'))}/{sum(1 for x in xray_findings if x.get('reused'))}")
     print(f"   Tables extracted: {sum(len(lab.get('tables', [])) for lab in lab_analysis)}")
     
     return results
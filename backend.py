@@ -1,15 +1,29 @@
-from fastapi import FastAPI, UploadFile, File, Form
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, FastAPI, UploadFile, File, Form, Query, Request
+from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.routing import APIRoute
+from python_multipart.multipart import parse_options_header
+from starlette.formparsers import MultiPartException, MultiPartParser
 from typing import List, Optional
-import os
-import uuid
-import tempfile
-import shutil
+import json
+import gzip
+import math
+from contextlib import aclosing
 from pathlib import Path
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # Import the simplified pipeline
-from ai_pipeline import run_pipeline
+from ai_pipeline import run_pipeline, parse_collection_date
 
 app = FastAPI(
     title="Medical SOAP Note Generator",
@@ -25,18 +39,141 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Global temp directory for session management
-TEMP_DIR = "temp"
-os.makedirs(TEMP_DIR, exist_ok=True)
+# Uploads are passed to the pipeline in memory. For /generate-soap only, each
+# uploaded file stays in RAM up to UPLOAD_SPOOL_MAX_BYTES instead of spilling
+# to disk after Starlette's 1MB default; larger files (the per-file limits are
+# 10MB text, 50MB lab, 20MB image) still spill. Worst-case upload RAM is about
+# 16MB x files per request x concurrent requests.
+UPLOAD_SPOOL_MAX_BYTES = 16 * 1024 * 1024
 
-def cleanup_temp_files(file_paths: List[str]):
-    """Clean up temporary files after processing"""
-    for file_path in file_paths:
-        try:
-            if file_path and os.path.exists(file_path):
-                os.remove(file_path)
-        except Exception as e:
-            print(f"Warning: Could not remove temp file {file_path}: {e}")
+class UploadSpoolParser(MultiPartParser):
+    """Multipart parser that keeps uploads up to UPLOAD_SPOOL_MAX_BYTES in memory"""
+    spool_max_size = UPLOAD_SPOOL_MAX_BYTES
+
+class UploadSpoolRoute(APIRoute):
+    """
+    Route that parses its multipart body with UploadSpoolParser.
+    Starlette has no public hook for the spool size, so the parsed form is
+    stored in the request's form cache (Request._form), which request.form()
+    returns as-is - checked against Starlette 1.8.0 / FastAPI 0.143.1. If that
+    cache ever goes away, uploads fall back to Starlette's default parsing.
+    """
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def route_handler(request: Request):
+            # Same content-type check as Request.form()
+            content_type, _ = parse_options_header(request.headers.get("Content-Type"))
+            if content_type == b"multipart/form-data" and getattr(request, "_form", False) is None:
+                try:
+                    async with aclosing(request.stream()) as stream:
+                        request._form = await UploadSpoolParser(request.headers, stream).parse()
+                except MultiPartException as exc:
+                    return JSONResponse(status_code=400, content={"error": exc.message})
+            return await handler(request)
+
+        return route_handler
+
+upload_router = APIRouter(route_class=UploadSpoolRoute)
+
+# Response views for /generate-soap and the top-level keys each one returns
+VIEW_FIELDS = {
+    "soap_only": ["soap_note", "api_metadata"],
+    "summary": ["summary", "soap_note", "api_metadata"],
+    "full": ["summary", "soap_note", "api_metadata"],
+}
+RESPONSE_VIEWS = list(VIEW_FIELDS)
+COMPRESSION_MIN_BYTES = 1024
+
+def shape_response(result: dict, view: str = "full", fields: Optional[List[str]] = None):
+    """Trim a pipeline result down to the requested view and top-level fields"""
+    if view == "soap_only":
+        shaped = {
+            "soap_note": result.get("soap_note"),
+            "api_metadata": result.get("api_metadata"),
+        }
+    elif view == "summary":
+        summary = result.get("summary", {})
+        shaped = {
+            "summary": {
+                "processed_files": summary.get("processed_files"),
+                "processing_method": summary.get("processing_method"),
+                # Only per-file metadata, not the full extracted text and tables
+                "lab_analysis": [lab.get("metadata", {}) for lab in summary.get("lab_analysis", [])],
+                # Drop server-side paths
+                "xray_findings": [
+                    {k: v for k, v in x.items() if k != "path"}
+                    for x in summary.get("xray_findings", [])
+                ],
+                "longitudinal": summary.get("longitudinal"),
+            },
+            "soap_note": result.get("soap_note"),
+            "api_metadata": result.get("api_metadata"),
+        }
+    else:
+        shaped = result
+
+    if fields:
+        shaped = {k: v for k, v in shaped.items() if k in fields}
+    return shaped
+
+def _replace_non_finite(value):
+    """Copy of value with NaN/Infinity floats replaced by None, as orjson encodes them"""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {k: _replace_non_finite(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_replace_non_finite(v) for v in value]
+    return value
+
+def encode_json(content) -> bytes:
+    """Serialize to JSON bytes, using orjson when available (both emit null for NaN)"""
+    if orjson is not None:
+        return orjson.dumps(content, default=str, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(_replace_non_finite(content), default=str, ensure_ascii=False,
+                      separators=(",", ":"), allow_nan=False).encode("utf-8")
+
+def negotiate_encoding(accept_encoding: str):
+    """Pick the best supported content encoding from an Accept-Encoding header"""
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        token, _, params = part.strip().partition(";")
+        token = token.strip().lower()
+        if not token:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[token] = q
+
+    candidates = ["br", "gzip"] if brotli is not None else ["gzip"]
+    for encoding in candidates:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+def build_json_response(request: Request, content, status_code: int = 200):
+    """Encode content as JSON and compress it according to the client's Accept-Encoding"""
+    body = encode_json(content)
+    headers = {"Vary": "Accept-Encoding"}
+
+    if len(body) >= COMPRESSION_MIN_BYTES:
+        encoding = negotiate_encoding(request.headers.get("accept-encoding", ""))
+        if encoding == "br":
+            body = brotli.compress(body, quality=4)
+            headers["Content-Encoding"] = "br"
+        elif encoding == "gzip":
+            body = gzip.compress(body, compresslevel=6)
+            headers["Content-Encoding"] = "gzip"
+
+    return Response(content=body, status_code=status_code, media_type="application/json", headers=headers)
 
 def validate_file_size(file: UploadFile, max_size_mb: int = 50):
     """Validate file size"""
@@ -76,12 +213,17 @@ async def health_check():
         }
     }
 
-@app.post("/generate-soap")
+@upload_router.post("/generate-soap")
 async def generate_soap(
+    request: Request,
+    view: str = Query("full", description="Response view: soap_only, summary or full"),
+    fields: Optional[str] = Query(None, description="Comma-separated top-level keys to return"),
     text_input: Optional[str] = Form(None),
     text_file: Optional[UploadFile] = File(None),
     table_files: List[UploadFile] = File([]),
     xray_images: List[UploadFile] = File([]),
+    patient_id: Optional[str] = Form(None),
+    collection_date: Optional[str] = Form(None),
 ):
     """
     Generate SOAP note from uploaded files and text input
@@ -90,11 +232,32 @@ async def generate_soap(
     - **text_file**: Optional text file with patient information
     - **table_files**: Lab reports (PDF, CSV, TXT)
     - **xray_images**: X-ray images (JPG, PNG, etc.)
+    - **patient_id**: Optional patient id; only lab results new since the patient's last note are sent to the model
+    - **collection_date**: Optional collection date (YYYY-MM-DD) for lab rows without one
+    - **view**: Response view - `soap_only`, `summary` (no extracted text/tables) or `full` (default)
+    - **fields**: Optional comma-separated list of top-level keys to keep
     """
     
-    temp_files = []  # Track all temp files for cleanup
-    
     try:
+        if view not in RESPONSE_VIEWS:
+            return JSONResponse(
+                status_code=400,
+                content={"error": f"Unknown view '{view}'. Allowed: {', '.join(RESPONSE_VIEWS)}"}
+            )
+        field_list = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+        unknown_fields = [f for f in field_list or [] if f not in VIEW_FIELDS[view]]
+        if unknown_fields:
+            return JSONResponse(
+                status_code=400,
+                content={"error": f"Unknown field(s) {', '.join(unknown_fields)} for view '{view}'. "
+                                  f"Allowed: {', '.join(VIEW_FIELDS[view])}"}
+            )
+
+        try:
+            collection_date = parse_collection_date(collection_date)
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"error": str(e)})
+
         # Validate input
         if not text_input and not text_file and not table_files and not xray_images:
             return JSONResponse(
@@ -103,7 +266,7 @@ async def generate_soap(
             )
 
         # Process text file
-        text_file_path = None
+        text_source = None
         if text_file:
             # Validate text file
             is_valid, error_msg = validate_file_size(text_file, 10)  # 10MB limit for text
@@ -114,15 +277,11 @@ async def generate_soap(
             if not is_valid:
                 return JSONResponse(status_code=400, content={"error": error_msg})
             
-            text_file_path = os.path.join(TEMP_DIR, f"{uuid.uuid4()}_{text_file.filename}")
-            temp_files.append(text_file_path)
-            
-            with open(text_file_path, "wb") as f:
-                content = await text_file.read()
-                f.write(content)
+            # Pass the spooled upload straight to the pipeline, no temp copy
+            text_source = (text_file.filename, text_file.file)
 
         # Process lab/table files
-        table_paths = []
+        lab_sources = []
         lab_file_extensions = ['.pdf', '.csv', '.txt', '.tsv']
         
         for file in table_files:
@@ -138,16 +297,10 @@ async def generate_soap(
             if not is_valid:
                 return JSONResponse(status_code=400, content={"error": error_msg})
             
-            path = os.path.join(TEMP_DIR, f"{uuid.uuid4()}_{file.filename}")
-            temp_files.append(path)
-            
-            with open(path, "wb") as f:
-                content = await file.read()
-                f.write(content)
-            table_paths.append(path)
+            lab_sources.append((file.filename, file.file))
 
         # Process X-ray images
-        xray_paths = []
+        xray_sources = []
         image_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.gif']
         
         for file in xray_images:
@@ -163,49 +316,39 @@ async def generate_soap(
             if not is_valid:
                 return JSONResponse(status_code=400, content={"error": error_msg})
             
-            path = os.path.join(TEMP_DIR, f"{uuid.uuid4()}_{file.filename}")
-            temp_files.append(path)
-            
-            with open(path, "wb") as f:
-                content = await file.read()
-                f.write(content)
-            xray_paths.append(path)
+            xray_sources.append((file.filename, file.file))
 
         # Log processing info
         print(f"Processing request:")
         print(f"  - Text input: {'Yes' if text_input else 'No'}")
-        print(f"  - Text file: {'Yes' if text_file_path else 'No'}")
-        print(f"  - Lab files: {len(table_paths)}")
-        print(f"  - X-ray files: {len(xray_paths)}")
+        print(f"  - Text file: {'Yes' if text_source else 'No'}")
+        print(f"  - Lab files: {len(lab_sources)}")
+        print(f"  - X-ray files: {len(xray_sources)}")
 
-        # Run the simplified pipeline
+        # Run the simplified pipeline on the in-memory uploads
         soap_result = run_pipeline(
             text_input=text_input,
-            text_file=text_file_path,
-            lab_files=table_paths,
-            xray_files=xray_paths
+            text_file=text_source,
+            lab_files=lab_sources,
+            xray_files=xray_sources,
+            patient_id=patient_id,
+            collection_date=collection_date,
+            save_artifacts=False
         )
 
         # Add processing metadata
         soap_result["api_metadata"] = {
             "files_processed": {
-                "text_files": 1 if text_file_path else 0,
-                "lab_files": len(table_paths),
-                "xray_files": len(xray_paths)
+                "text_files": 1 if text_source else 0,
+                "lab_files": len(lab_sources),
+                "xray_files": len(xray_sources)
             },
-            "processing_method": "pdfplumber_only",
-            "temp_files_created": len(temp_files)
+            "processing_method": "pdfplumber_only"
         }
 
-        # Clean up temp files
-        cleanup_temp_files(temp_files)
-
-        return JSONResponse(content=soap_result)
+        return build_json_response(request, shape_response(soap_result, view, field_list))
 
     except Exception as e:
-        # Clean up temp files in case of error
-        cleanup_temp_files(temp_files)
-        
         print(f"Error in generate_soap: {str(e)}")
         return JSONResponse(
             status_code=500,
@@ -216,6 +359,8 @@ async def generate_soap(
             }
         )
 
+app.include_router(upload_router)
+
 @app.post("/upload-test")
 async def upload_test(files: List[UploadFile] = File(...)):
     """Test endpoint for file uploads"""
@@ -231,37 +376,6 @@ async def upload_test(files: List[UploadFile] = File(...)):
     
     return {"uploaded_files": results}
 
-@app.delete("/cleanup")
-async def cleanup_temp_directory():
-    """Cleanup endpoint to remove old temp files"""
-    try:
-        if os.path.exists(TEMP_DIR):
-            # Remove files older than 1 hour
-            import time
-            current_time = time.time()
-            cleaned_count = 0
-            
-            for filename in os.listdir(TEMP_DIR):
-                file_path = os.path.join(TEMP_DIR, filename)
-                if os.path.isfile(file_path):
-                    file_age = current_time - os.path.getctime(file_path)
-                    if file_age > 3600:  # 1 hour
-                        os.remove(file_path)
-                        cleaned_count += 1
-            
-            return {
-                "message": f"Cleanup completed. Removed {cleaned_count} old files.",
-                "temp_directory": TEMP_DIR
-            }
-        else:
-            return {"message": "Temp directory does not exist"}
-    
-    except Exception as e:
-        return JSONResponse(
-            status_code=500,
-            content={"error": f"Cleanup failed: {str(e)}"}
-        )
-
 if __name__ == "__main__":
     import uvicorn
     
@@ -0,0 +1,101 @@
+"""
+Benchmark /generate-soap response size and encode time per view.
+
+Builds a pipeline-shaped result from the CSV fixtures in ./extracted_tables
+and reports, for each view, the raw JSON size, compressed sizes and the time
+taken by the stdlib json encoder vs. the encoder used by the API.
+
+    python bench_response.py [--copies N] [--repeat N]
+"""
+import argparse
+import csv
+import gzip
+import json
+import os
+import time
+
+from ai_pipeline import summarize_lab_data
+from backend import RESPONSE_VIEWS, shape_response, encode_json, brotli
+
+TABLES_DIR = "extracted_tables"
+
+
+def load_fixture_tables():
+    """Load fixture CSVs as lists of records, like the pipeline's 'tables'"""
+    tables = []
+    for name in sorted(os.listdir(TABLES_DIR)):
+        if name.endswith(".csv"):
+            with open(os.path.join(TABLES_DIR, name), newline="", encoding="utf-8") as f:
+                tables.append(list(csv.DictReader(f)))
+    return tables
+
+
+def build_result(copies):
+    """Build a result dict shaped like run_pipeline() output"""
+    tables = load_fixture_tables()
+    text = "\n".join(
+        ",".join(row.values()) for table in tables for row in table
+    )
+
+    lab_analysis = []
+    for i in range(copies):
+        lab_analysis.append({
+            "text": f"CSV file processed: report_{i}.csv\n" + text,
+            "tables": tables,
+            "metadata": {"source_file": f"report_{i}.csv", "type": "csv", "shape": [len(tables), 6]},
+        })
+
+    all_lab_data = {f"Table_{i+1}": t for i, t in enumerate(tables * copies)}
+
+    return {
+        "summary": {
+            "processed_files": {"lab_files": copies, "xray_files": 1, "text_files": 0},
+            "processing_method": "pdfplumber_only",
+            "lab_analysis": lab_analysis,
+            "xray_findings": [{
+                "file": "chest.jpeg",
+                "description": "PA chest radiograph. " * 50,
+                "path": "temp/00000000-0000-0000-0000-000000000000_chest.jpeg",
+            }],
+        },
+        "soap_note": {
+            "Subjective": "Patient presents with cough.",
+            "Objective": {"Laboratory_Results": summarize_lab_data(all_lab_data), "Imaging_Studies": "See findings"},
+            "Assessment": "Clinical correlation recommended",
+            "Plan": {"Follow_up": "Review in 2 weeks"},
+        },
+        "api_metadata": {"files_processed": {"lab_files": copies, "xray_files": 1}},
+    }
+
+
+def time_it(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--copies", type=int, default=5, help="Number of lab files in the synthetic bundle")
+    parser.add_argument("--repeat", type=int, default=20, help="Encode iterations per measurement")
+    args = parser.parse_args()
+
+    result = build_result(args.copies)
+
+    print(f"{'view':<10} {'raw KB':>9} {'gzip KB':>9} {'br KB':>9} {'stdlib ms':>10} {'encode ms':>10}")
+    for view in RESPONSE_VIEWS:
+        shaped = shape_response(result, view)
+        body = encode_json(shaped)
+        gz = len(gzip.compress(body, compresslevel=6))
+        br = len(brotli.compress(body, quality=4)) if brotli is not None else None
+
+        stdlib_ms = time_it(lambda: json.dumps(shaped).encode("utf-8"), args.repeat)
+        encode_ms = time_it(lambda: encode_json(shaped), args.repeat)
+
+        br_kb = f"{br / 1024:9.1f}" if br is not None else f"{'n/a':>9}"
+        print(f"{view:<10} {len(body) / 1024:9.1f} {gz / 1024:9.1f} {br_kb} {stdlib_ms:10.2f} {encode_ms:10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,524 @@
+"""
+Load-test harness for the FastAPI backend with a simulated model provider.
+
+Starts a fake OpenAI-compatible chat completions server (tunable latency and
+error rate), starts backend:app with GROQ_BASE_URL pointed at it (SDK retries
+pinned with --max-retries, default 0), and drives /generate-soap with a mix
+of multipart bundles built from the repo fixtures.
+Reports throughput, latency percentiles, error rates and server RSS over time,
+and writes a JSON report that can be compared against another build.
+
+    python loadtest.py run --concurrency 8 --duration 60 --mix text=2,lab=1,pdf=1,xray=1
+    python loadtest.py run --rate 5 --requests 200 --latency-ms 800 --error-rate 0.05
+    python loadtest.py run --url http://localhost:8000 --server-pid 1234
+    python loadtest.py run --mix xray=1 --identical-xrays   # measure the duplicate cache
+    python loadtest.py fake-provider --port 9100 --latency-ms 500
+    python loadtest.py compare before.json after.json
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+from ai_pipeline import is_fallback_note
+
+REPO_DIR = Path(__file__).resolve().parent
+BUNDLE_KINDS = ["text", "lab", "pdf", "xray"]
+
+# Markers of X-ray findings that fell back after a model/extraction failure
+# (fallback notes are detected with ai_pipeline.is_fallback_note)
+FALLBACK_DESCRIPTION_PREFIXES = ("Image Analysis Fallback", "Complete image analysis failure", "Error")
+
+FAKE_SOAP_NOTE = {
+    "Subjective": "Simulated subjective section.",
+    "Objective": {
+        "Vital_Signs": "Not documented",
+        "Physical_Examination": "Not documented",
+        "Laboratory_Results": "Simulated laboratory summary.",
+        "Imaging_Studies": "Simulated imaging summary."
+    },
+    "Assessment": "Simulated assessment.",
+    "Plan": {
+        "Immediate": "None",
+        "Follow_up": "Routine",
+        "Patient_Education": "Provided",
+        "Additional_Studies": "None"
+    }
+}
+
+
+# ---------------- 🤖 FAKE MODEL PROVIDER ----------------
+def create_fake_provider(latency_ms=500, jitter_ms=100, error_rate=0.0, seed=None):
+    """OpenAI-compatible /chat/completions app with simulated latency and failures"""
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse
+
+    app = FastAPI(title="Fake model provider")
+    rng = random.Random(seed)
+    stats = {"requests": 0, "vision": 0, "text": 0, "errors": 0}
+
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+
+        content = body.get("messages", [{}])[-1].get("content")
+        is_vision = isinstance(content, list) and any(part.get("type") == "image_url" for part in content)
+        stats["vision" if is_vision else "text"] += 1
+
+        delay = max(0.0, latency_ms + rng.uniform(-jitter_ms, jitter_ms)) / 1000
+        await asyncio.sleep(delay)
+
+        if rng.random() < error_rate:
+            stats["errors"] += 1
+            status = rng.choice([429, 500, 503])
+            return JSONResponse(status_code=status, content={"error": {"message": "Simulated provider error"}})
+
+        text = "Simulated radiograph description." if is_vision else json.dumps(FAKE_SOAP_NOTE)
+        return {
+            "id": f"chatcmpl-{stats['requests']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": text},
+                "finish_reason": "stop"
+            }],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        }
+
+    # Groq's SDK calls /openai/v1/..., the OpenAI SDK calls /v1/...
+    app.add_api_route("/openai/v1/chat/completions", chat_completions, methods=["POST"])
+    app.add_api_route("/v1/chat/completions", chat_completions, methods=["POST"])
+    app.add_api_route("/stats", lambda: stats, methods=["GET"])
+    return app
+
+
+# ---------------- 📦 REQUEST BUNDLES ----------------
+def load_fixtures():
+    """Read fixture bytes once; PDFs are rendered from the extracted page image"""
+    from PIL import Image
+
+    tables = sorted((REPO_DIR / "extracted_tables").glob("*.csv"))
+    xrays = sorted((REPO_DIR / "data" / "xrays").glob("*"))
+
+    pdf_buffer = io.BytesIO()
+    with Image.open(REPO_DIR / "extracted_images" / "page_1.jpeg") as page:
+        page.convert("RGB").save(pdf_buffer, format="PDF", resolution=150)
+
+    return {
+        "tables": [(p.name, p.read_bytes()) for p in tables],
+        "xrays": [(p.name, p.read_bytes()) for p in xrays],
+        "pdf": ("lab_report.pdf", pdf_buffer.getvalue())
+    }
+
+
+def vary_image(content, rng):
+    """Randomly flip and crop an image so it misses the X-ray description cache"""
+    from PIL import Image
+
+    with Image.open(io.BytesIO(content)) as img:
+        if rng.random() < 0.5:
+            img = img.transpose(Image.FLIP_LEFT_RIGHT)
+        width, height = img.size
+        dx, dy = int(width * rng.uniform(0.01, 0.05)), int(height * rng.uniform(0.01, 0.05))
+        img = img.crop((dx, dy, width - dx, height - dy))
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def build_bundle(kind, fixtures, rng, identical_xrays=False):
+    """
+    Return (data, files) for one /generate-soap multipart request.
+    X-ray fixtures are byte-identical, so each one is varied unless
+    identical_xrays is set; otherwise every request after the first would
+    measure the description cache instead of a vision call.
+    """
+    data = {"text_input": "Patient reports productive cough and fever for 3 days."}
+    files = []
+    if kind == "lab":
+        for name, content in rng.sample(fixtures["tables"], k=min(3, len(fixtures["tables"]))):
+            files.append(("table_files", (name, content, "text/csv")))
+    elif kind == "pdf":
+        name, content = fixtures["pdf"]
+        files.append(("table_files", (name, content, "application/pdf")))
+    elif kind == "xray":
+        name, content = rng.choice(fixtures["xrays"])
+        if not identical_xrays:
+            content = vary_image(content, rng)
+        files.append(("xray_images", (name, content, "image/jpeg")))
+    return data, files
+
+
+def parse_mix(mix):
+    """Parse 'text=2,pdf=1' into a {kind: weight} dict"""
+    weights = {}
+    for part in mix.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in BUNDLE_KINDS:
+            raise ValueError(f"Unknown bundle kind '{kind}'. Allowed: {', '.join(BUNDLE_KINDS)}")
+        weights[kind] = float(weight or 1)
+    return weights
+
+
+# ---------------- 📈 MEASUREMENT ----------------
+def read_rss_kb(pid):
+    """Resident set size of a process (and its children) in KB, from /proc"""
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(p) for p in f.read().split()]
+    except OSError:
+        pass
+
+    total = 0
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            continue
+    return total
+
+
+async def sample_rss(pid, interval, start, samples, stop):
+    while not stop.is_set():
+        samples.append({"t": round(time.perf_counter() - start, 2), "rss_mb": round(read_rss_kb(pid) / 1024, 1)})
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return round(sorted_values[index] * 1000, 1)
+
+
+def summarize(results, elapsed):
+    """Aggregate per-request results into throughput, latency and error stats"""
+    def latency_stats(rows):
+        latencies = sorted(r["latency"] for r in rows)
+        errors = sum(1 for r in rows if not r["ok"])
+        return {
+            "requests": len(rows),
+            "errors": errors,
+            "error_rate": round(errors / len(rows), 4) if rows else 0.0,
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+            "max_ms": round(latencies[-1] * 1000, 1) if latencies else None
+        }
+
+    status_counts = {}
+    for r in results:
+        status_counts[str(r["status"])] = status_counts.get(str(r["status"]), 0) + 1
+
+    overall = latency_stats(results)
+    overall.update({
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(len(results) / elapsed, 2) if elapsed else 0.0,
+        "status_codes": status_counts
+    })
+    by_kind = {
+        kind: latency_stats([r for r in results if r["kind"] == kind])
+        for kind in BUNDLE_KINDS if any(r["kind"] == kind for r in results)
+    }
+    return overall, by_kind
+
+
+# ---------------- 🚦 LOAD GENERATION ----------------
+def is_degraded(body):
+    """True if a 200 response carries a fallback note or failed findings"""
+    if "error" in body:
+        return True
+    if is_fallback_note(body.get("soap_note") or {}):
+        return True
+    summary = body.get("summary") or {}
+    for finding in summary.get("xray_findings", []):
+        if "error" in finding or str(finding.get("description", "")).startswith(FALLBACK_DESCRIPTION_PREFIXES):
+            return True
+    for lab in summary.get("lab_analysis", []):
+        metadata = lab.get("metadata", lab)  # summary view keeps only metadata
+        if "error" in metadata:
+            return True
+    return False
+
+
+async def send_request(client, url, kind, args, fixtures, rng, results):
+    data, files = build_bundle(kind, fixtures, rng, args.identical_xrays)
+    start = time.perf_counter()
+    status = None
+    try:
+        response = await client.post(f"{url}/generate-soap", params={"view": args.view}, data=data, files=files)
+        status = response.status_code
+        ok = status == 200
+        if ok and is_degraded(response.json()):
+            status, ok = "200-degraded", False
+    except Exception as e:
+        status = type(e).__name__
+        ok = False
+    results.append({"kind": kind, "status": status, "ok": ok, "latency": time.perf_counter() - start})
+
+
+async def drive_load(args, fixtures):
+    """Run the closed-loop (concurrency) or open-loop (arrival rate) workload"""
+    rng = random.Random(args.seed)
+    weights = parse_mix(args.mix)
+    kinds, kind_weights = list(weights), list(weights.values())
+    results = []
+    deadline = time.perf_counter() + args.duration if args.duration else None
+
+    def more_work(sent):
+        if args.requests and sent >= args.requests:
+            return False
+        return deadline is None or time.perf_counter() < deadline
+
+    limits = httpx.Limits(max_connections=max(args.concurrency, 100))
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        if args.rate:
+            # Open loop: Poisson arrivals at the target rate
+            tasks = []
+            sent = 0
+            while more_work(sent):
+                kind = rng.choices(kinds, kind_weights)[0]
+                tasks.append(asyncio.create_task(send_request(client, args.url, kind, args, fixtures, rng, results)))
+                sent += 1
+                await asyncio.sleep(rng.expovariate(args.rate))
+            await asyncio.gather(*tasks)
+        else:
+            # Closed loop: fixed number of in-flight requests
+            counter = {"sent": 0}
+
+            async def worker():
+                while more_work(counter["sent"]):
+                    counter["sent"] += 1
+                    kind = rng.choices(kinds, kind_weights)[0]
+                    await send_request(client, args.url, kind, args, fixtures, rng, results)
+
+            await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    return results
+
+
+# ---------------- 🖥️ PROCESS MANAGEMENT ----------------
+def start_server(module_app, port, env=None, extra_args=None):
+    cmd = [sys.executable, "-m", "uvicorn", module_app, "--host", "127.0.0.1", "--port", str(port),
+           "--log-level", "warning"] + (extra_args or [])
+    # The pipeline logs every request to stdout; keep stderr for tracebacks
+    return subprocess.Popen(cmd, cwd=REPO_DIR, env={**os.environ, **(env or {})}, stdout=subprocess.DEVNULL)
+
+
+def wait_for_http(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server at {url} did not start within {timeout}s")
+
+
+def stop_server(proc):
+    if proc and proc.poll() is None:
+        proc.send_signal(signal.SIGINT)
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, text=True).strip()
+    except Exception:
+        return None
+
+
+def run(args):
+    fixtures = load_fixtures()
+    provider = backend = None
+    server_pid = args.server_pid
+
+    try:
+        if not args.url:
+            provider_url = f"http://127.0.0.1:{args.provider_port}"
+            provider = start_server("loadtest:fake_provider_app", args.provider_port, env={
+                "FAKE_LATENCY_MS": str(args.latency_ms),
+                "FAKE_JITTER_MS": str(args.jitter_ms),
+                "FAKE_ERROR_RATE": str(args.error_rate),
+                "FAKE_SEED": "" if args.seed is None else str(args.seed),
+            })
+            wait_for_http(f"{provider_url}/stats")
+
+            # Pin the SDK's retries so --error-rate means what it says per model call
+            backend = start_server("backend:app", args.port,
+                                   env={"GROQ_BASE_URL": provider_url, "GROQ_MAX_RETRIES": str(args.max_retries)},
+                                   extra_args=["--workers", str(args.workers)])
+            args.url = f"http://127.0.0.1:{args.port}"
+            wait_for_http(f"{args.url}/health")
+            server_pid = backend.pid
+
+        print(f"Driving {args.url}/generate-soap "
+              f"({'rate ' + str(args.rate) + '/s' if args.rate else 'concurrency ' + str(args.concurrency)}, mix {args.mix})")
+
+        async def main():
+            rss_samples, stop = [], asyncio.Event()
+            start = time.perf_counter()
+            sampler = None
+            if server_pid:
+                sampler = asyncio.create_task(sample_rss(server_pid, args.rss_interval, start, rss_samples, stop))
+            results = await drive_load(args, fixtures)
+            elapsed = time.perf_counter() - start
+            stop.set()
+            if sampler:
+                await sampler
+            return results, elapsed, rss_samples
+
+        results, elapsed, rss_samples = asyncio.run(main())
+
+        provider_stats = None
+        if provider:
+            provider_stats = httpx.get(f"http://127.0.0.1:{args.provider_port}/stats").json()
+            requests_seen = provider_stats["requests"]
+            provider_stats["error_rate"] = round(provider_stats["errors"] / requests_seen, 4) if requests_seen else 0.0
+            provider_stats["max_retries"] = args.max_retries
+            provider_stats["calls_per_request"] = round(requests_seen / len(results), 2) if results else 0.0
+    finally:
+        stop_server(backend)
+        stop_server(provider)
+
+    overall, by_kind = summarize(results, elapsed)
+    report = {
+        "meta": {
+            "git_revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": {k: v for k, v in vars(args).items() if k not in ("func", "output")}
+        },
+        "overall": overall,
+        "by_kind": by_kind,
+        "rss": {
+            "peak_mb": max((s["rss_mb"] for s in rss_samples), default=None),
+            "samples": rss_samples
+        },
+        "provider": provider_stats
+    }
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    provider_error_rate = f"{provider_stats['error_rate']:.1%}" if provider_stats else "n/a"
+    print(f"\nRequests: {overall['requests']}  errors: {overall['errors']} ({overall['error_rate']:.1%}, "
+          f"provider {provider_error_rate})  throughput: {overall['throughput_rps']} req/s")
+    if provider_stats:
+        print(f"Model calls: {provider_stats['text']} text, {provider_stats['vision']} vision, "
+              f"{provider_stats['errors']} failed, {provider_stats['calls_per_request']} per request "
+              f"(SDK retries: {provider_stats['max_retries']})")
+    print(f"Latency ms  p50: {overall['p50_ms']}  p95: {overall['p95_ms']}  p99: {overall['p99_ms']}")
+    for kind, stats in by_kind.items():
+        print(f"  {kind:<5} n={stats['requests']:<5} p50={stats['p50_ms']}  p95={stats['p95_ms']}  errors={stats['errors']}")
+    if report["rss"]["peak_mb"] is not None:
+        print(f"Server peak RSS: {report['rss']['peak_mb']} MB")
+    print(f"Report written to {args.output}")
+
+
+def compare(args):
+    """Print the change in headline metrics between two reports"""
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    rows = [("throughput_rps", "overall"), ("p50_ms", "overall"), ("p95_ms", "overall"),
+            ("p99_ms", "overall"), ("error_rate", "overall"), ("error_rate", "provider"),
+            ("vision", "provider"), ("calls_per_request", "provider"), ("peak_mb", "rss")]
+    print(f"{'metric':<28} {'baseline':>12} {'candidate':>12} {'change':>9}")
+    for metric, section in rows:
+        before = (baseline.get(section) or {}).get(metric)
+        after = (candidate.get(section) or {}).get(metric)
+        change = f"{(after - before) / before:+.1%}" if before and after is not None else "n/a"
+        label = f"{section}.{metric}" if section == "provider" else metric
+        print(f"{label:<28} {str(before):>12} {str(after):>12} {change:>9}")
+
+
+def fake_provider(args):
+    import uvicorn
+    uvicorn.run(create_fake_provider(args.latency_ms, args.jitter_ms, args.error_rate, args.seed),
+                host="127.0.0.1", port=args.port, log_level="warning")
+
+
+# App instance for `uvicorn loadtest:fake_provider_app`, configured from the environment
+fake_provider_app = create_fake_provider(
+    latency_ms=float(os.environ.get("FAKE_LATENCY_MS", 500)),
+    jitter_ms=float(os.environ.get("FAKE_JITTER_MS", 100)),
+    error_rate=float(os.environ.get("FAKE_ERROR_RATE", 0.0)),
+    seed=int(os.environ["FAKE_SEED"]) if os.environ.get("FAKE_SEED") else None,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def add_provider_args(p):
+        p.add_argument("--latency-ms", type=float, default=500, help="Mean simulated model latency")
+        p.add_argument("--jitter-ms", type=float, default=100, help="Uniform jitter around the mean latency")
+        p.add_argument("--error-rate", type=float, default=0.0, help="Fraction of model calls that fail (429/5xx)")
+        p.add_argument("--seed", type=int, default=None)
+
+    run_parser = sub.add_parser("run", help="Start the fake provider and backend, then drive load")
+    add_provider_args(run_parser)
+    run_parser.add_argument("--url", help="Target an already running backend instead of starting one")
+    run_parser.add_argument("--server-pid", type=int, help="PID to sample RSS from when using --url")
+    run_parser.add_argument("--port", type=int, default=8765, help="Port for the spawned backend")
+    run_parser.add_argument("--provider-port", type=int, default=9100, help="Port for the fake provider")
+    run_parser.add_argument("--workers", type=int, default=1, help="uvicorn workers for the spawned backend")
+    run_parser.add_argument("--max-retries", type=int, default=0,
+                            help="GROQ_MAX_RETRIES for the spawned backend (SDK default is 2; ignored with --url)")
+    run_parser.add_argument("--mix", default="text=1,lab=1,pdf=1,xray=1", help="Bundle weights, e.g. text=2,xray=1")
+    run_parser.add_argument("--concurrency", type=int, default=4, help="In-flight requests (closed loop)")
+    run_parser.add_argument("--rate", type=float, help="Target arrivals per second (open loop; overrides concurrency)")
+    run_parser.add_argument("--duration", type=float, default=30, help="Seconds to run (0 = until --requests)")
+    run_parser.add_argument("--requests", type=int, help="Stop after this many requests")
+    run_parser.add_argument("--view", default="summary",
+                            help="view query parameter for /generate-soap (summary or full show degraded X-ray/lab findings)")
+    run_parser.add_argument("--identical-xrays", action="store_true",
+                            help="Send the fixture X-rays unchanged, so repeats hit the description cache")
+    run_parser.add_argument("--timeout", type=float, default=120, help="Per-request timeout in seconds")
+    run_parser.add_argument("--rss-interval", type=float, default=0.5, help="Seconds between RSS samples")
+    run_parser.add_argument("--output", default="loadtest_report.json", help="Where to write the JSON report")
+    run_parser.set_defaults(func=run)
+
+    provider_parser = sub.add_parser("fake-provider", help="Run only the fake OpenAI-compatible provider")
+    add_provider_args(provider_parser)
+    provider_parser.add_argument("--port", type=int, default=9100)
+    provider_parser.set_defaults(func=fake_provider)
+
+    compare_parser = sub.add_parser("compare", help="Compare two JSON reports")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    if args.command == "run" and not args.duration and not args.requests:
+        parser.error("run needs --duration or --requests")
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
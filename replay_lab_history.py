@@ -0,0 +1,150 @@
+"""
+Replay lab uploads for one patient against the longitudinal lab history.
+
+Runs run_pipeline() on in-memory CSV exports with a stubbed model client and a
+throwaway history directory, and checks what gets sent to the model and stored:
+
+  - a cumulative export without dates that grew by one row only adds that row
+  - a stable value on a new collection date is still a new result
+  - a long (summarized) export that grew by one row is re-read in full
+  - dd/mm/yyyy dates are normalized to ISO so trends come out oldest to newest
+  - a model failure leaves the stored history untouched
+  - an invalid collection_date is rejected
+  - concurrent requests for one patient don't lose each other's rows
+
+    python replay_lab_history.py
+"""
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+import ai_pipeline
+from ai_pipeline import run_pipeline, load_patient_history
+
+PATIENT = "replay-001"
+NOTE = '{"Subjective": "", "Objective": {}, "Assessment": "Stable", "Plan": {}}'
+
+
+class FakeCompletions:
+    """Stands in for groq_client.chat.completions; records prompts, can fail on demand"""
+
+    def __init__(self):
+        self.fail = False
+        self.delay = 0.0
+        self.prompts = []
+
+    def create(self, messages, **kwargs):
+        self.prompts.append(messages[0]["content"])
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("provider unavailable")
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=NOTE))])
+
+
+def csv_export(rows, dated=False):
+    """(name, bytes) lab source; rows are (analyte, value[, date])"""
+    header = "Test,Result,Unit,Date" if dated else "Test,Result,Unit"
+    lines = [header] + [
+        f"{r[0]},{r[1]},g/dL,{r[2]}" if dated else f"{r[0]},{r[1]},g/dL" for r in rows
+    ]
+    return ("export.csv", ("\n".join(lines) + "\n").encode("utf-8"))
+
+
+def replay(lab_source, collection_date, patient=PATIENT):
+    result = run_pipeline(lab_files=[lab_source], patient_id=patient,
+                          collection_date=collection_date, save_artifacts=False)
+    return result["summary"]["longitudinal"]
+
+
+def check(label, condition):
+    print(f"{'PASS' if condition else 'FAIL'}  {label}")
+    return condition
+
+
+def main():
+    completions = FakeCompletions()
+    ai_pipeline.groq_client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    ai_pipeline.HISTORY_DIR = tempfile.mkdtemp(prefix="patient_history_")
+    ok = True
+
+    # Cumulative export without dates, growing by one row per visit
+    visits = [("Hemoglobin", "13.1"), ("Hemoglobin", "12.5"), ("Hemoglobin", "13.1")]
+    stats = replay(csv_export(visits[:1]), "2024-01-05")
+    ok &= check("first export stores one result", stats["new"] == 1 and stats["saved"])
+    stats = replay(csv_export(visits[:2]), "2024-02-05")
+    ok &= check("grown export adds only the new row", (stats["new"], stats["unchanged"]) == (1, 1))
+    stats = replay(csv_export(visits), "2024-03-05")
+    ok &= check("repeated value in grown export is a new result",
+                (stats["new"], stats["unchanged"], stats["results_on_file"]) == (1, 2, 3))
+
+    # Failed note: nothing new is stored, the same upload is new again next time
+    completions.fail = True
+    stats = replay(csv_export(visits + [("Hemoglobin", "11.8")]), "2024-04-05")
+    stored = load_patient_history(PATIENT)
+    ok &= check("model failure does not update the store",
+                not stats["saved"] and len(stored["results"]) == 3)
+    completions.fail = False
+    stats = replay(csv_export(visits + [("Hemoglobin", "11.8")]), "2024-04-05")
+    ok &= check("retry after failure reports the row as new", stats["new"] == 1 and stats["saved"])
+
+    # dd/mm/yyyy dates: 12/01/2023 is before 01/05/2024
+    dated = [("Platelets", "150", "01/05/2024"), ("Platelets", "210", "12/01/2023")]
+    replay(csv_export(dated, dated=True), None)
+    stored = load_patient_history(PATIENT)["results"]
+    ok &= check("dates are stored as ISO",
+                {"platelets|2023-01-12", "platelets|2024-05-01"} <= set(stored))
+    ok &= check("trend runs oldest to newest",
+                "210 (2023-01-12) -> 150 (2024-05-01)" in completions.prompts[-1])
+
+    # Separate report with a stable value: still recorded for the new visit
+    replay(csv_export([("Hemoglobin", "13.1"), ("WBC", "7.0")]), "2024-01-05", "replay-002")
+    stats = replay(csv_export([("Hemoglobin", "13.1"), ("WBC", "9.0")]), "2024-02-05", "replay-002")
+    stored = load_patient_history("replay-002")["results"]
+    ok &= check("stable value on a new date is a new result",
+                stats["new"] == 2 and "hemoglobin|2024-02-05" in stored)
+
+    # Report with no date from any source: matched by value
+    replay(csv_export([("Hemoglobin", "13.1")]), None, "replay-003")
+    stats = replay(csv_export([("Hemoglobin", "13.1"), ("WBC", "8.0")]), None, "replay-003")
+    ok &= check("undated report matches stored values", (stats["new"], stats["unchanged"]) == (1, 1))
+
+    # Export longer than CSV_FULL_MAX_ROWS, then the same export plus one row
+    long_rows = [("Glucose", str(90 + i % 20), f"{1 + i % 28:02d}/{1 + i // 28 % 12:02d}/{2000 + i // 336}")
+                 for i in range(600)]
+    stats = replay(csv_export(long_rows, dated=True), None, "replay-004")
+    ok &= check("long export stores every row", stats["new"] == 600)
+    ok &= check("prompt gets a bounded number of rows",
+                '"New_Results_omitted": 100' in completions.prompts[-1])
+    stats = replay(csv_export(long_rows + [("Glucose", "101", "01/01/2010")], dated=True), None, "replay-004")
+    ok &= check("grown long export adds only the new row",
+                (stats["files_skipped"], stats["new"], stats["unchanged"]) == (0, 1, 600))
+
+    # Concurrent requests for one patient
+    completions.delay = 0.3
+    threads = [
+        threading.Thread(target=replay, args=(csv_export([(analyte, "1.0")]), "2024-01-05", "replay-005"))
+        for analyte in ("Sodium", "Potassium")
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    completions.delay = 0.0
+    stored = load_patient_history("replay-005")["results"]
+    ok &= check("concurrent requests keep both rows", len(stored) == 2)
+
+    # Invalid collection_date
+    try:
+        replay(csv_export(visits), "05/04/2024")
+        ok &= check("invalid collection_date is rejected", False)
+    except ValueError:
+        ok &= check("invalid collection_date is rejected", True)
+
+    print(f"\nHistory written to {ai_pipeline.HISTORY_DIR}")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()